@@ -1,29 +1,129 @@
 import os
+import csv
+import hashlib
 import pandas as pd
+import xlsxwriter
 from datetime import datetime
 from openpyxl import load_workbook, Workbook
 
+# 最新の定義ヘッダー
+EXPECTED_HEADERS = [
+    "登録日時", "旅券番号", "氏名(姓)", "氏名(名)", 
+    "生年月日", "性別", "国籍", "本籍", "発行年月日", "有効期間満了日", 
+    "住所(手入力)", "備考", "画像ファイル名"
+]
+# ヘッダー定義が変わると値も変わる (マイグレーション済みかの判定用)
+EXPECTED_SCHEMA_VERSION = hashlib.md5("|".join(EXPECTED_HEADERS).encode()).hexdigest()[:8]
+
+# EXPECTED_HEADERS の「登録日時」と「画像ファイル名」の間に並ぶ列に対応する data のキー
+_ROW_KEYS = (
+    "passport_no", "surname", "given_name", "birth_date", "sex", "nationality",
+    "domicile", "issue_date", "expiry_date", "address", "note",
+)
+
+def build_row(data, image_filename="", registered_at=None):
+    """
+    EXPECTED_HEADERS の順に並んだ1行分の値 (list) を作る。
+    data: dict (ocr_utils.parse_response の戻り値 + 住所など)
+    registered_at: 登録日時の文字列 (省略時は現在時刻)
+    """
+    if registered_at is None:
+        registered_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return [registered_at, *(data.get(k, "") for k in _ROW_KEYS), image_filename]
+
+def pending_csv_path(file_path):
+    """未反映の追記行を溜めておくCSVのパス (Excelファイルの隣に置く)"""
+    return os.path.splitext(file_path)[0] + "_pending.csv"
+
+def parquet_cache_path(file_path):
+    """xlsx の内容を高速に読み直すための Parquet の写しのパス (Excelファイルの隣に置く)"""
+    return os.path.splitext(file_path)[0] + ".parquet"
+
+def _parquet_source_path(file_path):
+    # Parquet の写しの元になった xlsx の更新時刻・サイズを記録するファイル
+    return parquet_cache_path(file_path) + ".src"
+
+def _xlsx_stamp(file_path):
+    st = os.stat(file_path)
+    return f"{st.st_mtime_ns} {st.st_size}"
+
+def _write_parquet_cache(df, file_path):
+    """df を file_path (xlsx) の写しとして Parquet に保存する。xlsx を書き終えてから呼ぶこと"""
+    src_path = _parquet_source_path(file_path)
+    try:
+        # 書き込み途中で失敗しても古い記録と新しい Parquet が組にならないよう、記録を先に消す
+        if os.path.exists(src_path):
+            os.remove(src_path)
+        # read_excel はカテゴリ型を返さないので、読み直しと同じ型にそろえてから書く
+        # (カテゴリ型のまま読み戻すと load_data_as_df の fillna("") が TypeError になる)
+        df = df.astype({c: object for c in df.select_dtypes("category").columns})
+        df.to_parquet(parquet_cache_path(file_path), index=False, compression="zstd")
+        with open(src_path, "w") as f:
+            f.write(_xlsx_stamp(file_path))
+    except Exception:
+        # pyarrow が無い・列の型が混在しているなどで書けない場合はキャッシュしない
+        # (記録が無い・一致しない写しは読まれないので、残っていても害はない)
+        pass
+
+def _read_excel_cached(file_path):
+    """
+    xlsx を DataFrame として読む。
+    隣の Parquet がこの xlsx (更新時刻・サイズが一致) から作ったものならそちらを読む (read_excel より桁違いに速く、型もそのまま)。
+    「xlsx より新しいか」では判定しない (古い更新時刻のまま差し替えられた xlsx を見落とすため)。
+    xlsx が書き換えられていれば読み直して Parquet を作り直す。
+    """
+    try:
+        with open(_parquet_source_path(file_path)) as f:
+            if f.read() == _xlsx_stamp(file_path):
+                return pd.read_parquet(parquet_cache_path(file_path))
+    except (OSError, ImportError, ValueError):
+        pass
+    df = pd.read_excel(file_path)
+    _write_parquet_cache(df, file_path)
+    return df
+
+def _schema_marker_path(file_path):
+    return file_path + ".schema"
+
+def _write_schema_marker(file_path):
+    """列定義が最新であることを隣のファイルに記録する (Excelの更新時刻も含め、外部での差し替えを検知する)"""
+    with open(_schema_marker_path(file_path), "w") as f:
+        f.write(f"{EXPECTED_SCHEMA_VERSION} {os.stat(file_path).st_mtime_ns}")
+
+def _schema_is_current(file_path):
+    try:
+        with open(_schema_marker_path(file_path)) as f:
+            token = f.read()
+    except OSError:
+        return False
+    return token == f"{EXPECTED_SCHEMA_VERSION} {os.stat(file_path).st_mtime_ns}"
+
 def init_excel(file_path):
     """Excelファイルが存在しない場合、ヘッダー付きで作成する"""
     if not os.path.exists(file_path):
         wb = Workbook()
         ws = wb.active
         ws.title = "Passport Data"
-        headers = [
-            "登録日時", "旅券番号", "氏名(姓)", "氏名(名)", 
-            "生年月日", "性別", "国籍", "本籍", "発行年月日", "有効期間満了日", 
-            "住所(手入力)", "備考", "画像ファイル名"
-        ]
-        ws.append(headers)
+        ws.append(EXPECTED_HEADERS)
         # 親ディレクトリ作成
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
         wb.save(file_path)
+        _write_schema_marker(file_path)
 
 def load_data_as_df(file_path):
     """ExcelデータをDataFrameとして読み込む"""
-    if not os.path.exists(file_path):
+    frames = []
+    if os.path.exists(file_path):
+        frames.append(_read_excel_cached(file_path))
+
+    # export_excel 前の追記行も含める
+    csv_path = pending_csv_path(file_path)
+    if os.path.exists(csv_path):
+        frames.append(pd.read_csv(csv_path, dtype=str, keep_default_na=False))
+
+    if not frames:
         return pd.DataFrame()
-    df = pd.read_excel(file_path)
+    df = pd.concat(frames, ignore_index=True)
     return df.fillna("")
 
 def ensure_excel_columns(file_path):
@@ -33,16 +133,21 @@ def ensure_excel_columns(file_path):
     """
     if not os.path.exists(file_path):
         return
+    # マイグレーション済みなら読み込み自体を省略
+    if _schema_is_current(file_path):
+        return
 
     try:
+        # まずヘッダー行だけを読む (read_only なので全セルは解析しない)
+        wb = load_workbook(file_path, read_only=True)
+        header_row = next(wb.active.iter_rows(max_row=1, values_only=True), ())
+        wb.close()
+        if list(header_row) == EXPECTED_HEADERS:
+            _write_schema_marker(file_path)
+            return
+
         df = pd.read_excel(file_path)
-        
-        # 最新の定義ヘッダー
-        expected_headers = [
-            "登録日時", "旅券番号", "氏名(姓)", "氏名(名)", 
-            "生年月日", "性別", "国籍", "本籍", "発行年月日", "有効期間満了日", 
-            "住所(手入力)", "備考", "画像ファイル名"
-        ]
+        expected_headers = EXPECTED_HEADERS
         
         changed = False
         # 足りない列を追加
@@ -60,46 +165,93 @@ def ensure_excel_columns(file_path):
             # 新しい順序で再構築
             new_df = df.reindex(columns=expected_headers)
             new_df.to_excel(file_path, index=False)
+        _write_schema_marker(file_path)
             
     except Exception as e:
         print(f"Migration failed: {e}")
 
-# save_passport_data の前にマイグレーションを実行するように変更
 def save_passport_data(file_path, data, image_filename=""):
     """
-    パスポートデータをExcelに追記する。
+    パスポートデータを追記する。
+    毎回Excel全体を読み書きすると件数に比例して遅くなるため、
+    行は隣のCSVに追記だけしておき、Excelへは export_excel でまとめて反映する。
     data: dict (ocr_utils.parse_mrz の戻り値 + 住所など)
     """
+    csv_path = pending_csv_path(file_path)
+    is_new = not os.path.exists(csv_path)
+    if is_new:
+        os.makedirs(os.path.dirname(csv_path) or ".", exist_ok=True)
+
+    row = build_row(data, image_filename)
+
+    with open(csv_path, "a", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        if is_new:
+            writer.writerow(EXPECTED_HEADERS)
+        writer.writerow(row)
+
+def export_excel(file_path):
+    """
+    CSVに溜まった追記行をExcelへ反映する。
+    書き出しは write_only モードで行い、件数に関わらずメモリ使用量を一定に保つ。
+    """
+    csv_path = pending_csv_path(file_path)
+    if not os.path.exists(csv_path):
+        return
+
+    rows = []
     if os.path.exists(file_path):
         ensure_excel_columns(file_path)
-    else:
-        init_excel(file_path)
-    
-    wb = load_workbook(file_path)
-    ws = wb.active
-    
-    row = [
-        datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        data.get("passport_no", ""),
-        data.get("surname", ""),
-        data.get("given_name", ""),
-        data.get("birth_date", ""),
-        data.get("sex", ""),
-        data.get("nationality", ""),
-        data.get("domicile", ""),
-        data.get("issue_date", ""),
-        data.get("expiry_date", ""),
-        data.get("address", ""),
-        data.get("note", ""),
-        image_filename
-    ]
-    
-    ws.append(row)
+        src = load_workbook(file_path, read_only=True)
+        rows.extend(src.active.iter_rows(min_row=2, values_only=True))
+        src.close()
+
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        next(reader, None) # ヘッダー行
+        rows.extend(reader)
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Passport Data")
+    ws.append(EXPECTED_HEADERS)
+    for row in rows:
+        ws.append(row)
+    os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
     wb.save(file_path)
+    _write_schema_marker(file_path)
+    os.remove(csv_path)
+
+def write_xlsx(df, target, sheet_name="Passport Data"):
+    """
+    DataFrame を xlsxwriter の constant_memory モードで書き出す (target はパスまたは BytesIO)。
+    constant_memory は行を上から順に書く必要があるが、pandas の to_excel は列ごとに書くため
+    (データが欠ける)、ここで1行ずつ write_row する。NaN は空セルになる。
+    日時のセルには to_excel と同じく日付の書式を付ける (付けないとシリアル値の数字で表示される)。
+    """
+    wb = xlsxwriter.Workbook(target, {
+        "constant_memory": True,
+        "default_date_format": "yyyy-mm-dd hh:mm:ss",
+        "remove_timezone": True,
+    })
+    ws = wb.add_worksheet(sheet_name)
+    ws.write_row(0, 0, [str(c) for c in df.columns])
+    values = df.astype(object).where(df.notna(), None)
+    for r, row in enumerate(values.itertuples(index=False, name=None), start=1):
+        ws.write_row(r, 0, row)
+    wb.close()
 
 def save_all_data(file_path, df):
     """
     DataFrameの内容でExcelファイルを上書き保存する（削除・編集反映用）
     """
     if df is None: return
-    df.to_excel(file_path, index=False)
+    # xlsxwriter はセルごとのスタイルオブジェクトを作らないので openpyxl より書き出しが速い
+    write_xlsx(df, file_path)
+    _write_parquet_cache(df, file_path)
+    # 列構成は df 次第なので、次回のマイグレーションで改めて確認させる
+    if os.path.exists(_schema_marker_path(file_path)):
+        os.remove(_schema_marker_path(file_path))
+    # df は load_data_as_df で追記行も含めて読み込んだものなので、二重にならないよう破棄
+    csv_path = pending_csv_path(file_path)
+    if os.path.exists(csv_path):
+        os.remove(csv_path)
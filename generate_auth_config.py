@@ -1,9 +1,19 @@
+import os
 import yaml
 import bcrypt
+from concurrent.futures import ThreadPoolExecutor
+
+# bcryptのコスト (本番は既定の12。開発・CIでは BCRYPT_COST=4 などに下げると即時に終わる)
+BCRYPT_COST = int(os.environ.get("BCRYPT_COST", "12"))
+
+def hash_password(p):
+    return bcrypt.hashpw(p.encode(), bcrypt.gensalt(BCRYPT_COST)).decode()
 
 # streamlit-authenticator用のハッシュ生成 (bcrypt使用)
+# bcrypt はハッシュ計算中にGILを解放するので、スレッドで並列に計算できる
 passwords = ['abc123', 'def456']
-hashed_passwords = [bcrypt.hashpw(p.encode(), bcrypt.gensalt()).decode() for p in passwords]
+with ThreadPoolExecutor() as ex:
+    hashed_passwords = list(ex.map(hash_password, passwords))
 
 config = {
     'credentials': {
@@ -35,7 +45,7 @@ config = {
 }
 
 with open('auth_config.yaml', 'w') as file:
-    yaml.dump(config, file, default_flow_style=False)
+    yaml.dump(config, file, Dumper=getattr(yaml, 'CSafeDumper', yaml.SafeDumper), default_flow_style=False)
 
 print("auth_config.yaml generated.")
 print(f"User1 Password: abc123")
@@ -1,6 +1,10 @@
+import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from collections import defaultdict
+from functools import lru_cache
 import unicodedata
 
 month_map = {
@@ -8,50 +12,130 @@ month_map = {
     "JUL": "07", "AUG": "08", "SEP": "09", "OCT": "10", "NOV": "11", "DEC": "12"
 }
 
+# parse_date_from_text 用 (呼び出しごとにパターンを解釈しないよう事前コンパイル)
+_MONTH_ALT = '|'.join(month_map)
+_DATE_SEP_RE = re.compile(r'[^A-Z0-9]+')
+_DAY_ALT = r'(0?[1-9]|[12]\d|3[01])'
+_DATE_DMY_RE = re.compile(r'\b' + _DAY_ALT + r'\s*(' + _MONTH_ALT + r')\s*((?:19|20)\d{2})\b')
+_DATE_MDY_RE = re.compile(r'\b(' + _MONTH_ALT + r')\s*' + _DAY_ALT + r'\s+((?:19|20)\d{2})\b')
+_MONTH_RE = re.compile(_MONTH_ALT)
+_YEAR_RE = re.compile(r'\b(19|20)\d{2}\b')
+_DAY_RE = re.compile(r'\b(\d{1,2})\b')
+
 # Image Preprocessing
 import cv2
 import numpy as np
 from PIL import Image
 
-def preprocess_image_for_ocr(pil_image):
+# 前処理で毎回作り直さないようにモジュール読み込み時に1度だけ生成
+_DILATE_KERNEL = np.ones((2, 2), np.uint8)
+# CLAHE オブジェクトは内部バッファを持ちスレッド間で共有できないため、スレッドごとに1つ生成して使い回す
+_clahe_local = threading.local()
+# これより大きい画像は前処理前に縮小する (長辺px)。MRZの判読には十分な解像度
+PREPROCESS_MAX_SIDE = 1600
+# 輝度の標準偏差がこれを超える (十分にコントラストがある) 画像は、平滑化〜適応的2値化を省いて大津の2値化だけ行う
+PREPROCESS_HIGH_CONTRAST_STD = 60
+# OCR_USE_OPENCL=1 の場合、OpenCLデバイスがあれば前処理を T-API (cv2.UMat) でGPUに流す
+USE_OPENCL = os.environ.get("OCR_USE_OPENCL") == "1" and cv2.ocl.haveOpenCL()
+if USE_OPENCL:
+    cv2.ocl.setUseOpenCL(True)
+
+def _get_clahe():
+    clahe = getattr(_clahe_local, "clahe", None)
+    if clahe is None:
+        clahe = _clahe_local.clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+    return clahe
+
+def preprocess_array_for_ocr(img):
     """
     低画質・FAX画像向けの前処理を行う。
     1. グレースケール化
     2. 平滑化 (ノイズ除去)
     3. 膨張処理 (かすれた文字を繋げる)
-    Returns: Processed PIL Image (JPEG bytes are handled by caller typically, but here we return PIL)
+    長辺が PREPROCESS_MAX_SIDE を超える画像は縮小される。
+    コントラストが十分な画像 (PREPROCESS_HIGH_CONTRAST_STD) は 2〜4 を省き、大津の2値化のみ行う。
+    img: np.ndarray (RGB / RGBA / Gray) または PIL Image
+    Returns: 2値化済みの np.ndarray (uint8)。PILへの変換を挟まずに扱える
     """
-    # Convert PIL to OpenCV (BGR)
-    img = np.array(pil_image)
-    if img.shape[2] == 4: # RGBA -> RGB
-         img = cv2.cvtColor(img, cv2.COLOR_RGBA2RGB)
-    
+    if isinstance(img, Image.Image):
+        img = np.asarray(img)
+
     # 1. Grayscale
-    gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-    
+    # RGBA は RGB を経由せず直接グレースケール化する (アルファは無視されるので中間バッファ不要)
+    if img.ndim == 2:
+        gray = img.copy() # 以降は in-place で書き換えるので呼び出し元の配列は触らない
+    elif img.shape[2] == 4:
+        gray = cv2.cvtColor(img, cv2.COLOR_RGBA2GRAY)
+    else:
+        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+
+    # スマホ写真など巨大な画像は縮小してから処理する (以降の各段は画素数に比例するため)
+    h, w = gray.shape[:2]
+    scale = PREPROCESS_MAX_SIDE / max(h, w)
+    if scale < 1.0:
+        gray = cv2.resize(gray, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+
+    # きれいな写真・スキャンは重い前処理がかえって文字を崩すので、大津の2値化だけで返す
+    if cv2.meanStdDev(gray)[1][0, 0] > PREPROCESS_HIGH_CONTRAST_STD:
+        cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU, dst=gray)
+        return gray
+
+    if USE_OPENCL:
+        return _preprocess_gray_umat(gray)
+
+    # 以降の各段は gray と buf の2枚を交互に使い回し、段ごとの画像確保をしない
+    buf = np.empty_like(gray)
+
     # 2. Gaussian Blur (Reduce dot noise)
     # カーネルサイズ (3,3) 程度で軽くぼかす
-    blurred = cv2.GaussianBlur(gray, (3, 3), 0)
+    cv2.GaussianBlur(gray, (3, 3), 0, dst=buf)
     
     
     # 3. Dilation (Thicken text)
     # 文字が途切れている場合に有効。カーネルサイズは小さめに。
-    kernel = np.ones((2, 2), np.uint8)
-    dilated = cv2.dilate(blurred, kernel, iterations=1)
+    cv2.dilate(buf, _DILATE_KERNEL, dst=gray, iterations=1)
     
     # Optional: Contrast Enhancement (CLAHE)
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-    enhanced = clahe.apply(dilated)
+    _get_clahe().apply(gray, dst=buf)
     
     # 4. Adaptive Thresholding (Binarization) - NEW
     # 照明ムラや汚れに強い適応的2値化を行い、完全に白黒にする
     # Block Size: 11, C: 2 (調整パラメータ)
-    binary = cv2.adaptiveThreshold(enhanced, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, \
-                                   cv2.THRESH_BINARY, 11, 2)
+    cv2.adaptiveThreshold(buf, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, \
+                          cv2.THRESH_BINARY, 11, 2, dst=gray)
 
-    # Convert back to PIL
-    final_img = Image.fromarray(binary)
-    return final_img
+    return gray
+
+
+def _preprocess_gray_umat(gray):
+    """preprocess_array_for_ocr の 2〜4 を OpenCL (UMat) 上で行い、最後に1度だけ np.ndarray に戻す"""
+    umat = cv2.UMat(gray)
+    umat = cv2.GaussianBlur(umat, (3, 3), 0)
+    umat = cv2.dilate(umat, _DILATE_KERNEL, iterations=1)
+    umat = _get_clahe().apply(umat)
+    umat = cv2.adaptiveThreshold(umat, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
+    return umat.get()
+
+
+def preprocess_image_for_ocr(pil_image):
+    """
+    preprocess_array_for_ocr の PIL 版 (互換用)。
+    Returns: Processed PIL Image (JPEG bytes are handled by caller typically, but here we return PIL)
+    """
+    return Image.fromarray(preprocess_array_for_ocr(pil_image))
+
+
+def preprocess_batch(pil_images, max_workers=None):
+    """
+    複数画像の前処理をスレッドプールで並列に行う。
+    OpenCV の処理中は GIL が解放されるので、コア数に応じて並列に進む。
+    Returns: 入力と同じ順序の Processed PIL Image のリスト
+    """
+    pil_images = list(pil_images)
+    if len(pil_images) <= 1:
+        return [preprocess_image_for_ocr(img) for img in pil_images]
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        return list(executor.map(preprocess_image_for_ocr, pil_images))
 
 
 # 日本の都道府県リスト（ローマ字・ヘボン式）
@@ -64,6 +148,8 @@ JAPAN_PREFECTURES = {
     "TOKUSHIMA", "KAGAWA", "EHIME", "KOCHI",
     "FUKUOKA", "SAGA", "NAGASAKI", "KUMAMOTO", "OITA", "MIYAZAKI", "KAGOSHIMA", "OKINAWA"
 }
+# 上記の1パス検索用 (長い名前を先に並べ、同じ位置では長い方が一致する)
+PREFECTURE_RE = re.compile('|'.join(sorted(JAPAN_PREFECTURES, key=len, reverse=True)))
 
 def parse_response(response):
     """
@@ -129,128 +215,134 @@ def merge_val(primary, secondary, default=""):
 # Layout Based Parsing (VIZ)
 # ----------------------------------------------------------------------------
 
+# Update Targets: Use simpler single-word labels for better matching results.
+VIZ_TARGETS = [
+    {'key': 'passport_no', 'labels': ['Passport', 'No', '旅券番号'], 'dir': 'BELOW', 'pat': re.compile(r'([A-Z]{2}\s*\d{7})')},
+    {'key': 'surname', 'labels': ['Surname', '姓'], 'dir': 'BELOW', 'pat': re.compile(r'([A-Z]+)')},
+    {'key': 'given_name', 'labels': ['Given', '名'], 'dir': 'BELOW', 'pat': re.compile(r'([A-Z]+)')},
+    {'key': 'nationality', 'labels': ['Nationality', '国籍'], 'dir': 'BELOW', 'pat': re.compile(r'(JAPAN|JPN)')},
+    {'key': 'birth_date', 'labels': ['Birth', '生年月日'], 'dir': 'BELOW', 'pat': re.compile(r'\d{1,2}\s+[A-Z]{3}\s+\d{4}')},
+    {'key': 'sex', 'labels': ['Sex', '性別'], 'dir': 'BELOW', 'pat': re.compile(r'[MF]')},
+    {'key': 'issue_date', 'labels': ['Issue', '発行年月日'], 'dir': 'BELOW', 'pat': re.compile(r'\d{1,2}\s+[A-Z]{3}\s+\d{4}')}, # Added Issue
+    {'key': 'domicile', 'labels': ['Registered', 'Domicile', '本籍'], 'dir': 'BELOW', 'pat': re.compile(r'([A-Z]+)')}, # Added Domicile
+    {'key': 'expiry_date', 'labels': ['Expiry', '有効期間満了日'], 'dir': 'BELOW', 'pat': re.compile(r'\d{1,2}\s+[A-Z]{3}\s+\d{4}')}
+]
+
+# Label lookup built once from VIZ_TARGETS:
+# short labels ("No", "姓", ...) must match the whole word, long labels may be contained (e.g. "EXPIRY" in "DATE OF EXPIRY")
+_PUNCT_TBL = str.maketrans('', '', '.:')
+_SHORT_LABELS = {}
+_LONG_LABELS = []
+for _tgt in VIZ_TARGETS:
+    for _lbl in _tgt['labels']:
+        _lbl_upper = _lbl.upper().translate(_PUNCT_TBL)
+        if len(_lbl_upper) > 3:
+            _LONG_LABELS.append((_lbl_upper, _tgt['key']))
+        else:
+            _SHORT_LABELS[_lbl_upper] = _tgt['key']
+_LONG_LABELS = tuple(_LONG_LABELS)
+del _tgt, _lbl, _lbl_upper
+
+# Stop words (label words that end a value)
+_STOP_WORDS = frozenset({
+    "NAME", "SURNAME", "GIVEN", "DATE", "BIRTH", "EXPIRY", "SEX", "NATIONALITY", "PASSPORT", "NO", "JAPAN", "ISSUING", "COUNTRY", 
+    "MINISTRY", "FOREIGN", "AFFAIRS", "REGISTERED", "DOMICILE", "SIGNATURE", "BEARER", "AUTHORITY", "TYPE", "JPN", "ISSUE",
+    "旅券番号", "姓", "名", "国籍", "生年月日", "性別", "有効期間満了日", "所持人自署", "発行官庁", "型", "発行国", "本籍", "発行年月日"
+})
+# Japanese label fragments (OCR might merge "名/Given")
+_JP_STOP_RE = re.compile('|'.join(["名", "姓", "国籍", "生年月日", "性別", "有効期間"]))
+
+# Value clean-up patterns (compiled once)
+_SEX_RE = re.compile(r'\b([MF])\b')
+_DOMICILE_JUNK_RE = re.compile(r'[\*0-9<:;,\.]')
+_JP_DATE_LABEL_RE = re.compile(r'[発行年月日]')
+_NAME_JUNK_RE = re.compile(r'[0-9<:;,\.]')
+_SLASH_WORD_RE = re.compile(r'/[a-zA-Z]*')
+_PASSPORT_NO_RE = re.compile(r'([A-Z]{2})\s*(\d{7})')
+
+
 def parse_viz_layout(annotations, full_text=""):
     data = {}
-    
-    # ... (get_center and get_bbox remain same) ...
-
-    # Helper to calculate center of word
-    def get_center(ann):
-        vs = ann.bounding_poly.vertices
-        x = sum([v.x for v in vs]) / 4
-        y = sum([v.y for v in vs]) / 4
-        return x, y
-
-    # Helper to get bounding box
-    def get_bbox(ann):
-        vs = ann.bounding_poly.vertices
-        min_x = min([v.x for v in vs])
-        max_x = max([v.x for v in vs])
-        min_y = min([v.y for v in vs])
-        max_y = max([v.y for v in vs])
-        return min_x, min_y, max_x, max_y
-
-    # Update Targets: Use simpler single-word labels for better matching results.
-    targets = [
-        {'key': 'passport_no', 'labels': ['Passport', 'No', '旅券番号'], 'dir': 'BELOW', 'pat': r'([A-Z]{2}\s*\d{7})'},
-        {'key': 'surname', 'labels': ['Surname', '姓'], 'dir': 'BELOW', 'pat': r'([A-Z]+)'},
-        {'key': 'given_name', 'labels': ['Given', '名'], 'dir': 'BELOW', 'pat': r'([A-Z]+)'},
-        {'key': 'nationality', 'labels': ['Nationality', '国籍'], 'dir': 'BELOW', 'pat': r'(JAPAN|JPN)'},
-        {'key': 'birth_date', 'labels': ['Birth', '生年月日'], 'dir': 'BELOW', 'pat': r'\d{1,2}\s+[A-Z]{3}\s+\d{4}'},
-        {'key': 'sex', 'labels': ['Sex', '性別'], 'dir': 'BELOW', 'pat': r'[MF]'},
-        {'key': 'issue_date', 'labels': ['Issue', '発行年月日'], 'dir': 'BELOW', 'pat': r'\d{1,2}\s+[A-Z]{3}\s+\d{4}'}, # Added Issue
-        {'key': 'domicile', 'labels': ['Registered', 'Domicile', '本籍'], 'dir': 'BELOW', 'pat': r'([A-Z]+)'}, # Added Domicile
-        {'key': 'expiry_date', 'labels': ['Expiry', '有効期間満了日'], 'dir': 'BELOW', 'pat': r'\d{1,2}\s+[A-Z]{3}\s+\d{4}'}
-    ]
-
-    # Stop words
-    stop_words = {
-        "NAME", "SURNAME", "GIVEN", "DATE", "BIRTH", "EXPIRY", "SEX", "NATIONALITY", "PASSPORT", "NO", "JAPAN", "ISSUING", "COUNTRY", 
-        "MINISTRY", "FOREIGN", "AFFAIRS", "REGISTERED", "DOMICILE", "SIGNATURE", "BEARER", "AUTHORITY", "TYPE", "JPN", "ISSUE",
-        "旅券番号", "姓", "名", "国籍", "生年月日", "性別", "有効期間満了日", "所持人自署", "発行官庁", "型", "発行国", "本籍", "発行年月日"
-    }
 
-    # Pre-process: Identify Label Annotations
+    # Geometry as Structure-of-Arrays (computed once per call, indexed by annotation position)
+    # Vision API returns 4 vertices per word box -> (N, 4, 2) array, filled in a single pass
+    n = len(annotations)
+    verts = np.fromiter(
+        (c for ann in annotations for v in ann.bounding_poly.vertices for c in (v.x, v.y)),
+        dtype=np.float64, count=8 * n,
+    ).reshape(n, 4, 2)
+    mins = verts.min(axis=1)
+    maxs = verts.max(axis=1)
+    min_x, min_y = mins[:, 0], mins[:, 1]
+    max_x, max_y = maxs[:, 0], maxs[:, 1]
+    cx = verts[:, :, 0].mean(axis=1)
+
+    # 注釈ごとの文字列正規化は1回だけ行い、ラベル判定・ストップワード判定・結合で使い回す
+    descs = [ann.description.strip() for ann in annotations]
+    norms = [d.upper().translate(_PUNCT_TBL).strip() for d in descs]
+    is_stop = np.fromiter((t in _STOP_WORDS for t in norms), dtype=bool, count=n)
+
+    # Pre-process: Identify Label Annotations (stores annotation indices)
     matched_labels = defaultdict(list)
     
-    for ann in annotations:
-        text = ann.description.strip().upper().replace('.', '').replace(':', '')
-        for tgt in targets:
-            for lbl in tgt['labels']:
-                lbl_upper = lbl.upper().replace('.', '').replace(':', '')
-                # Strict check for short words, containment for long words
-                if lbl_upper == text:
-                    matched_labels[tgt['key']].append(ann)
-                elif len(lbl_upper) > 3 and lbl_upper in text:
-                    # Allow "EXPIRY" in "DATE OF EXPIRY"
-                    matched_labels[tgt['key']].append(ann)
+    for i, text in enumerate(norms):
+        # Strict check for short words, containment for long words
+        key = _SHORT_LABELS.get(text)
+        if key:
+            matched_labels[key].append(i)
+        for lbl_upper, key in _LONG_LABELS:
+            if lbl_upper in text:
+                matched_labels[key].append(i)
+
+    # Topmost (then leftmost) label is the base of each found target
+    found_targets = [tgt for tgt in VIZ_TARGETS if matched_labels[tgt['key']]]
+    base_idxs = np.array(
+        [min(matched_labels[tgt['key']], key=lambda i: (min_y[i], min_x[i])) for tgt in found_targets],
+        dtype=np.intp,
+    )
+    bx1, by1, bx2, by2 = (a[base_idxs, None] for a in (min_x, min_y, max_x, max_y))
+    base_h = by2 - by1
+    base_w = bx2 - bx1
+
+    # BELOW (all targets): ROI of every target against every annotation in one (targets, N) pass
+    # - Strictly below: start just below top of label (sometimes label is multiline or big)
+    # - Immediately below: max gap ~2 lines (slightly relaxed vertical)
+    # - X alignment: Japanese passport is left or center aligned.
+    #   IMPORTANT: If label is "Expiry" (at end of line), the value "15 SEP 2028" DETECTED TO THE LEFT.
+    #   So we need a large Left tolerance, but not too large to cross into "Date of issue" column.
+    roi_masks = (
+        (min_y > by1 + base_h * 0.1)
+        & ((min_y - by2) < base_h * 2.5)
+        & (cx > bx1 - base_w * 8)
+        & (cx < bx2 + base_w * 5)
+    )
+    roi_masks[np.arange(len(found_targets)), base_idxs] = False
 
     # Search Values relative to Labels
-    for tgt in targets:
+    for tgt, mask in zip(found_targets, roi_masks):
         key = tgt['key']
-        labels_found = matched_labels[key]
-        if not labels_found:
-            continue
-            
-        labels_found.sort(key=lambda a: (get_bbox(a)[1], get_bbox(a)[0]))
-        base_ann = labels_found[0]
-        
-        bx1, by1, bx2, by2 = get_bbox(base_ann)
-        base_h = by2 - by1
-        base_w = bx2 - bx1
-        
-        roi_candidates = []
-        
-        for ann in annotations:
-            if ann == base_ann: continue
-            
-            # Skip if this annotation matches ANY label keyword (It's likely another label)
-            txt_upper = ann.description.upper().replace('.', '').replace(':', '').strip()
-            
-            # Japanese stop word check (partial match allowed for short japanese words?)
-            # No, text_annotations usually split by word.
-            if key != 'nationality' and txt_upper in stop_words:
-                 continue
-            
-            # Strict stop for JAPAN if key is nationality (it's the value itself)
-            # But for other keys, "JAPAN" is a stop word (next field label "JAPAN / Nationality")
 
-            ax1, ay1, ax2, ay2 = get_bbox(ann)
-            acx, acy = get_center(ann)
-            
-            is_candidate = False
-            
-            if tgt['dir'] == 'BELOW':
-                # Strictly below
-                if ay1 > (by1 + base_h * 0.1): # Start just below top of label (sometimes label is multiline or big)
-                     # Check if it is *immediately* below.
-                     # Max gap: 2 lines height max.
-                     if (ay1 - by2) < (base_h * 2.5): # Slightly relaxed vertical
-                         # Check X alignment: mostly overlaps with the label column
-                         # Japanese passport: Left aligned or Center aligned.
-                         # IMPORTANT: If label is "Expiry" (at end of line), the value "15 SEP 2028" DETECTED TO THE LEFT.
-                         # So we need a large Left tolerance.
-                         # But not too large to cross into "Date of issue" column (which is to the left).
-                         if (bx1 - base_w*8) < acx < (bx2 + base_w*5):
-                             is_candidate = True
-            
-            if is_candidate:
-                roi_candidates.append(ann)
+        # Skip if this annotation matches ANY label keyword (It's likely another label)
+        # Strict stop for JAPAN if key is nationality (it's the value itself)
+        # But for other keys, "JAPAN" is a stop word (next field label "JAPAN / Nationality")
+        if key != 'nationality':
+            mask &= ~is_stop
+        roi_candidates = np.nonzero(mask)[0]
         
-        if roi_candidates:
-            roi_candidates.sort(key=lambda a: (get_bbox(a)[1], get_bbox(a)[0]))
+        if roi_candidates.size:
+            # Reading order: top to bottom, then left to right
+            roi_candidates = roi_candidates[np.lexsort((min_x[roi_candidates], min_y[roi_candidates]))]
             
             combined_text = ""
-            for ann in roi_candidates:
-                word = ann.description.strip()
-                w_upper = word.upper().replace('.','')
+            for i in roi_candidates:
+                word = descs[i]
                 
                 # Check stop words
-                if key != 'nationality' and w_upper in stop_words:
+                if key != 'nationality' and is_stop[i]:
                      break # Stop reading further
                 
                 # Check Japanese specific stop words containment (OCR might merge "名/Given")
-                if any(sw in word for sw in ["名", "姓", "国籍", "生年月日", "性別", "有効期間"]):
+                if _JP_STOP_RE.search(word):
                     if len(word) > 1 and key not in ['surname', 'given_name']: # Name fields might contain Kanji in JP passport? No, usually English VIZ.
                         break
                 
@@ -264,7 +356,7 @@ def parse_viz_layout(annotations, full_text=""):
                  if date_val: data[key] = date_val
             
             elif key == 'sex':
-                m = re.search(r'\b([MF])\b', combined_text.upper())
+                m = _SEX_RE.search(combined_text.upper())
                 if m: data[key] = m.group(1)
             
             elif key == 'nationality':
@@ -281,20 +373,19 @@ def parse_viz_layout(annotations, full_text=""):
                 
                 # 1. 完全一致検索（ノイズの中に都道府県名が含まれているか）
                 # 例: "Sex OKINAWA of 所持" -> "OKINAWA"
-                for pref in JAPAN_PREFECTURES:
-                    if pref in upper_text:
-                        found_pref = pref
-                        break
+                m_pref = PREFECTURE_RE.search(upper_text)
+                if m_pref:
+                    found_pref = m_pref.group(0)
                 
                 if found_pref:
                     data[key] = found_pref
                 else:
                     # 見つからない場合は従来のクリーニングロジックで頑張る
                     # （OCRミスで "T0KYO" となっている場合などへの最低限の対応）
-                    clean_val = re.sub(r'[\*0-9<:;,\.]', '', combined_text).strip()
+                    clean_val = _DOMICILE_JUNK_RE.sub('', combined_text).strip()
                     
                     # 日本語ラベルの除去
-                    m_jp = re.search(r'[発行年月日]', clean_val)
+                    m_jp = _JP_DATE_LABEL_RE.search(clean_val)
                     if m_jp:
                         clean_val = clean_val[:m_jp.start()].strip()
 
@@ -303,53 +394,59 @@ def parse_viz_layout(annotations, full_text=""):
                         data[key] = " ".join(valid_parts)
 
             elif key == 'passport_no':
-                m = re.search(r'([A-Z]{2}\s*\d{7})', combined_text)
+                m = tgt['pat'].search(combined_text)
                 if m: data[key] = m.group(1).replace(' ', '')
 
             else:
                 # Name cleaning
-                clean_val = re.sub(r'[0-9<:;,\.]', '', combined_text).strip()
+                clean_val = _NAME_JUNK_RE.sub('', combined_text).strip()
                 # Remove common garbage like "/" or "Nati" if partly matched
-                clean_val = re.sub(r'/[a-zA-Z]*', '', clean_val).strip()
+                clean_val = _SLASH_WORD_RE.sub('', clean_val).strip()
                 if clean_val: data[key] = clean_val
 
     # Special Fallback for Passport No (search in FULL TEXT)
     if not data.get('passport_no') and full_text:
         # Search for MJ 1234567 or similar in the whole text
-        m = re.search(r'([A-Z]{2})\s*(\d{7})', full_text)
+        m = _PASSPORT_NO_RE.search(full_text)
         if m:
             data['passport_no'] = f"{m.group(1)}{m.group(2)}"
 
     return data
 
 
+@lru_cache(maxsize=256)
 def parse_date_from_text(text):
     # Pattern: 13 FEB 2020 or 13FEB2020 or 13 FEB2020
-    # Normalize: Remove non-alphanumeric except space
-    clean = re.sub(r'[^A-Z0-9\s]', ' ', text.upper())
-    norm = re.sub(r'\s+', ' ', clean).strip()
-    
-    # Try with English Month
-    for mon, num in month_map.items():
-        if mon in norm:
-            # Match variants: "13 FEB 2020", "13FEB 2020", "FEB 13 2020"
-            # 1. DD MMM YYYY or DDMMM YYYY
-            # Look for YYYY (19xx or 20xx)
-            year_match = re.search(r'\b(19|20)\d{2}\b', norm)
-            if not year_match: continue
-            
-            y_str = year_match.group(0)
-            
-            # Look for Day (1-31) exclude year
-            # Remove year from string to avoid confusion
-            rem_str = norm.replace(y_str, '')
-            
-            # Simple digit search nearby the month
-            day_match = re.search(r'\b(\d{1,2})\b', rem_str)
-            if day_match:
-                d_str = day_match.group(1)
-                return f"{y_str}/{num}/{d_str.zfill(2)}"
-                
+    # Normalize: every run of non-alphanumerics (symbols and whitespace) becomes one space
+    norm = _DATE_SEP_RE.sub(' ', text.upper()).strip()
+
+    # 1. DD MMM YYYY / DDMMMYYYY, then MMM DD YYYY (1回の走査で日・月・年をまとめて取る)
+    m = _DATE_DMY_RE.search(norm)
+    if m:
+        d_str, mon, y_str = m.groups()
+        return f"{y_str}/{month_map[mon]}/{d_str.zfill(2)}"
+    m = _DATE_MDY_RE.search(norm)
+    if m:
+        mon, d_str, y_str = m.groups()
+        return f"{y_str}/{month_map[mon]}/{d_str.zfill(2)}"
+
+    # 2. Fallback: 並びが崩れている場合 (例: "SEP 2028 15")
+    mon_match = _MONTH_RE.search(norm)
+    if not mon_match:
+        return ""
+    # Look for YYYY (19xx or 20xx)
+    year_match = _YEAR_RE.search(norm)
+    if not year_match:
+        return ""
+    y_str = year_match.group(0)
+
+    # Look for Day (1-31) exclude year
+    # Remove year from string to avoid confusion
+    rem_str = norm.replace(y_str, '')
+    day_match = _DAY_RE.search(rem_str)
+    if day_match:
+        return f"{y_str}/{month_map[mon_match.group(0)]}/{day_match.group(1).zfill(2)}"
+
     return ""
 
 
@@ -357,18 +454,25 @@ def parse_date_from_text(text):
 # MRZ Parsing (Robust Fallback)
 # ----------------------------------------------------------------------------
 
+# (, ), {, }, [, ] are common misreadings of the '<' filler
+_MRZ_BRACKET_TRANS = str.maketrans('(){}[]', '<<<<<<')
+# Document number: first 9 chars of Line 2
+_MRZ_DOC_NO_RE = re.compile(r'([A-Z0-9]{9})')
+# Common OCR misreadings in MRZ digit fields (O->0, I->1, D->0, S->5, B->8, Z->2)
+_MRZ_DIGIT_FIX = str.maketrans('OIDSBZ', '010582')
+# 数字を取り除く変換表 (len の差で数字の個数を数える)
+_DIGIT_STRIP = str.maketrans('', '', '0123456789')
+
 def parse_mrz_text(text):
+    # 結果の dict は呼び出し側で書き換えられても良いよう、キャッシュとは別のコピーを返す
+    # 生年月日の世紀は現在の年で決まるので、年もキャッシュのキーに含める (年をまたいだら解析し直す)
+    return dict(_parse_mrz_text(text, datetime.now().year % 100))
+
+@lru_cache(maxsize=64)
+def _parse_mrz_text(text, current_yy):
     data = {}
     lines = [line.strip() for line in text.split('\n') if line.strip()]
     
-    # Identify MRZ lines
-    candidates = []
-    for line in lines:
-        clean = line.replace(' ', '').upper()
-        # MRZ line is 44 chars, but OCR might split or shrink
-        if len(clean) > 20: 
-            candidates.append(clean)
-            
     # Identify MRZ lines
     candidates = []
     # Clean lines logic needs improvement.
@@ -377,10 +481,14 @@ def parse_mrz_text(text):
         # replace common misreadings of <
         clean = line.strip().upper().replace(' ', '')
         # (, ), {, }, [, ] -> < (Removed K and C as they are valid chars)
-        clean = re.sub(r'[\(\){}\[\]]', '<', clean)
+        clean = clean.translate(_MRZ_BRACKET_TRANS)
         
         if len(clean) > 10: 
             candidates.append(clean)
+
+    # Per-candidate character stats, scanned once and shared by both strategies below
+    digit_counts = [len(seq) - len(seq.translate(_DIGIT_STRIP)) for seq in candidates]
+    filler_counts = [seq.count('<') for seq in candidates]
             
     line1 = line2 = None
     
@@ -391,7 +499,7 @@ def parse_mrz_text(text):
     for i, seq in enumerate(candidates):
         # Heuristic for Line 2: At least 50% numbers? or specific length 44?
         # Check if it looks like Line 2
-        digit_count = sum(c.isdigit() for c in seq)
+        digit_count = digit_counts[i]
         # MRZ Line 2 normally has at least 20 digits.
         # But allow lower for bad OCR (say 10)
         
@@ -414,7 +522,7 @@ def parse_mrz_text(text):
                      break
                  # If prev line doesn't start with P, maybe OCR missed the P?
                  # If it has many <, take it.
-                 elif prev_seq.count('<') >= 2:
+                 elif filler_counts[i-1] >= 2:
                      line1 = prev_seq
                      line2 = curr_l2
                      break
@@ -423,10 +531,10 @@ def parse_mrz_text(text):
     if not line1 or not line2:
         for i, seq in enumerate(candidates):
             if seq.startswith('P') and '<' in seq:
-                 if seq.count('<') >= 2:
+                 if filler_counts[i] >= 2:
                      if i + 1 < len(candidates):
                          seq2 = candidates[i+1]
-                         if sum(c.isdigit() for c in seq2) > 5:
+                         if digit_counts[i+1] > 5:
                              line1, line2 = seq, seq2
                              break
                              
@@ -434,17 +542,9 @@ def parse_mrz_text(text):
         data['raw_mrz'] = f"{line1}\n{line2}"
         
         # --- MRZ Line 2 Correction Logic ---
-        # Same correction as before
-        l2_chars = list(line2)
-        for idx in [13,14,15,16,17,18, 21,22,23,24,25,26]:
-             if idx < len(l2_chars):
-                 if l2_chars[idx] == 'O': l2_chars[idx] = '0'
-                 if l2_chars[idx] == 'I': l2_chars[idx] = '1'
-                 if l2_chars[idx] == 'D': l2_chars[idx] = '0'
-                 if l2_chars[idx] == 'S': l2_chars[idx] = '5'
-                 if l2_chars[idx] == 'B': l2_chars[idx] = '8'
-                 if l2_chars[idx] == 'Z': l2_chars[idx] = '2'
-        line2 = "".join(l2_chars)
+        # Same correction as before: digit-only fields (DOB 13-18, Expiry 21-26)
+        line2 = (line2[:13] + line2[13:19].translate(_MRZ_DIGIT_FIX)
+                 + line2[19:21] + line2[21:27].translate(_MRZ_DIGIT_FIX) + line2[27:])
         # -----------------------------------
 
         try:
@@ -503,29 +603,35 @@ def parse_mrz_text(text):
         try:
             # Passport No extraction from Line 2
             # First 9 chars usually. 
-            m = re.match(r'([A-Z0-9]{9})', line2)
+            m = _MRZ_DOC_NO_RE.match(line2)
             if m: data['passport_no'] = m.group(1).replace('<', '')
             
             # Find DOB: look for digits
             # usually pos 13-19
             if len(line2) > 19:
                 dob = line2[13:19]
-                if dob.isdigit(): data['birth_date'] = convert_yymmdd_to_fmt(dob)
+                if dob.isdigit(): data['birth_date'] = convert_yymmdd_to_fmt(dob, current_yy=current_yy)
                 data['sex'] = line2[20]
                 exp = line2[21:27]
-                if exp.isdigit(): data['expiry_date'] = convert_yymmdd_to_fmt(exp, future=True)
+                if exp.isdigit(): data['expiry_date'] = convert_yymmdd_to_fmt(exp, future=True, current_yy=current_yy)
         except: pass
         
     return data
 
-def convert_yymmdd_to_fmt(yymmdd, future=False):
+def convert_yymmdd_to_fmt(yymmdd, future=False, current_yy=None):
     if not yymmdd or len(yymmdd) < 6: return yymmdd
+    # 世紀の判定は現在の年に依存するので、年もキャッシュのキーに含める
+    if current_yy is None:
+        current_yy = datetime.now().year % 100
+    return _convert_yymmdd(yymmdd, future, current_yy)
+
+@lru_cache(maxsize=512)
+def _convert_yymmdd(yymmdd, future, current_yy):
     try:
         y = int(yymmdd[0:2])
         m = int(yymmdd[2:4])
         d = int(yymmdd[4:6])
         if m < 1 or m > 12: return yymmdd # Invalid month
-        current_yy = int(datetime.now().year) % 100
         
         if future:
              full_year = 2000 + y